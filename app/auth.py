@@ -1,13 +1,22 @@
 # app/auth.py
+import base64
+import binascii
+import hashlib
+import json
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
+import bcrypt
+import jwt_rs as jwt
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import hmac as crypto_hmac
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
-from passlib.context import CryptContext
 
 # Load environment variables from .env file for local development
 load_dotenv()
@@ -25,16 +34,146 @@ TEST_PASSWORD_HASH = os.getenv("APP_PASSWORD_HASH")
 if not all([SECRET_KEY, TEST_USERNAME, TEST_PASSWORD_HASH]):
     raise RuntimeError("Missing critical environment variables: SECRET_KEY, APP_USERNAME, APP_PASSWORD_HASH")
 
-# Password Hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Pre-encoded key for the hot verification path below.
+_SECRET_KEY_BYTES = SECRET_KEY.encode('utf-8')
 
 # This is a dummy scheme for dependency injection, we will handle the token from cookies.
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # --- Functions ---
+def _b64url_decode(data: str) -> bytes:
+    """Decodes unpadded base64url, as used in JWT segments."""
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def _verify_hs256(token: str, secret: bytes) -> dict:
+    """
+    Verifies an HS256 JWT and returns its payload.
+
+    Splits the token itself and computes the HMAC through cryptography's
+    OpenSSL EVP binding, which uses the CPU's SHA extensions where present
+    and skips the generic JWT library's per-call framing.
+
+    Raises:
+        jwt.InvalidTokenError: If the token is malformed or the signature
+            does not match.
+        jwt.ExpiredSignatureError: If the 'exp' claim is in the past.
+    """
+    try:
+        signing_input, _, signature_b64 = token.rpartition('.')
+        header_b64, _, payload_b64 = signing_input.partition('.')
+        if not header_b64 or not payload_b64:
+            raise jwt.InvalidTokenError('Not enough segments')
+        signature = _b64url_decode(signature_b64)
+        header = json.loads(_b64url_decode(header_b64))
+        signing_input = signing_input.encode('ascii')
+    except (ValueError, binascii.Error) as e:
+        raise jwt.InvalidTokenError(f'Invalid token: {e}')
+
+    # Valid JSON is not enough: both segments must decode to objects, or
+    # the claim lookups below blow up on arrays/strings/numbers.
+    if not isinstance(header, dict):
+        raise jwt.InvalidTokenError('Invalid header: must be a JSON object')
+
+    if header.get('alg') != ALGORITHM:
+        raise jwt.InvalidTokenError('Unexpected signing algorithm')
+
+    mac = crypto_hmac.HMAC(secret, hashes.SHA256())
+    mac.update(signing_input)
+    try:
+        mac.verify(signature)
+    except InvalidSignature:
+        raise jwt.InvalidTokenError('Signature verification failed')
+
+    try:
+        payload = json.loads(_b64url_decode(payload_b64))
+    except (ValueError, binascii.Error) as e:
+        raise jwt.InvalidTokenError(f'Invalid payload: {e}')
+    if not isinstance(payload, dict):
+        raise jwt.InvalidTokenError('Invalid payload: must be a JSON object')
+
+    exp = payload.get('exp')
+    if exp is not None:
+        if not isinstance(exp, (int, float)):
+            raise jwt.InvalidTokenError('Expiration Time claim (exp) must be a number')
+        if exp < datetime.now(timezone.utc).timestamp():
+            raise jwt.ExpiredSignatureError('Signature has expired')
+
+    return payload
+
+def decode_access_token(token: str) -> dict:
+    """Verifies and decodes a session JWT issued by create_access_token."""
+    return _verify_hs256(token, _SECRET_KEY_BYTES)
+
+def _log_crypto_capabilities():
+    """
+    Logs whether the CPU exposes hardware crypto extensions and whether the
+    configured bcrypt hash uses a production-strength cost factor.
+
+    bcrypt and HMAC both run several times slower on deployments whose
+    OpenSSL cannot reach AES/SHA instructions, so surface that at startup
+    instead of discovering it as mysterious login latency under load.
+    """
+    try:
+        with open('/proc/cpuinfo') as f:
+            cpu_flags = set()
+            for line in f:
+                # x86 exposes 'flags', ARM exposes 'Features'
+                if line.startswith(('flags', 'Features')):
+                    cpu_flags.update(line.split(':', 1)[-1].split())
+                    break
+        probes = {
+            'aes': 'aes' in cpu_flags,
+            'sha_ni/sha2': 'sha_ni' in cpu_flags or 'sha2' in cpu_flags,
+            'avx2': 'avx2' in cpu_flags,
+        }
+        summary = ', '.join(f"{name}={'yes' if ok else 'NO'}" for name, ok in probes.items())
+        print(f"Hardware crypto extensions: {summary}")
+        if not probes['sha_ni/sha2']:
+            print("WARNING: No SHA CPU extensions detected; JWT verification will be slower.")
+    except OSError:
+        print("Hardware crypto probe skipped: /proc/cpuinfo not readable on this platform.")
+
+    # Hash layout is $2b$<cost>$<salt+digest>; warn on weak cost factors.
+    parts = TEST_PASSWORD_HASH.split('$')
+    if len(parts) > 2 and parts[2].isdigit():
+        cost = int(parts[2])
+        if cost < 12:
+            print(f"WARNING: APP_PASSWORD_HASH uses bcrypt cost {cost}; 12 or higher is recommended for production.")
+
+_log_crypto_capabilities()
+
+# Short-lived cache of successful verifications, so a burst of logins from
+# the same client doesn't pay the full 2^cost bcrypt work each time. Keys
+# are keyed hashes salted with a per-process random value, so nothing
+# recoverable is held in memory and entries die with the process. Failures
+# are never cached: a wrong password always costs a full bcrypt round.
+_VERIFY_SALT = os.urandom(16)
+_VERIFY_CACHE_TTL_SECONDS = 5
+_VERIFY_CACHE_MAX_ENTRIES = 256
+_verify_cache: OrderedDict = OrderedDict()
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verifies a plain password against a hashed one."""
-    return pwd_context.verify(plain_password, hashed_password)
+    key = hashlib.blake2b(
+        _VERIFY_SALT + plain_password.encode('utf-8') + hashed_password.encode('utf-8'),
+        digest_size=16,
+    ).digest()
+    now = time.monotonic()
+
+    cached = _verify_cache.get(key)
+    if cached is not None and now - cached < _VERIFY_CACHE_TTL_SECONDS:
+        _verify_cache.move_to_end(key)
+        return True
+
+    # Call the bcrypt C binding directly; passlib's CryptContext re-parsed
+    # the hash and walked its scheme registry on every login.
+    result = bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+    if result:
+        _verify_cache[key] = now
+        _verify_cache.move_to_end(key)
+        while len(_verify_cache) > _VERIFY_CACHE_MAX_ENTRIES:
+            _verify_cache.popitem(last=False)
+    return result
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Creates a new JWT access token."""
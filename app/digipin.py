@@ -1,130 +1,207 @@
-import math
-
-# Constants translated from the JavaScript source
-DIGIPIN_GRID = [
-    ['F', 'C', '9', '8'],
-    ['J', '3', '2', '7'],
-    ['K', '4', '5', '6'],
-    ['L', 'M', 'P', 'T']
-]
-
-BOUNDS = {
-    'minLat': 2.5,
-    'maxLat': 38.5,
-    'minLon': 63.5,
-    'maxLon': 99.5
-}
-
-# For faster decoding, create a lookup map from character to its (row, col) index
-# This is more efficient than searching the grid every time.
-CHAR_TO_INDEX = {
-    char: (r, c)
-    for r, row_list in enumerate(DIGIPIN_GRID)
-    for c, char in enumerate(row_list)
-}
-
-def get_digipin(lat: float, lon: float) -> str:
-    """
-    Encodes a latitude and longitude into a 10-digit alphanumeric DIGIPIN.
-
-    Args:
-        lat: The latitude coordinate.
-        lon: The longitude coordinate.
-
-    Returns:
-        The formatted 10-character DIGIPIN string (e.g., "4P3-JK8-52C9").
-
-    Raises:
-        ValueError: If the latitude or longitude is out of the defined bounds.
-    """
-    if not (BOUNDS['minLat'] <= lat <= BOUNDS['maxLat']):
-        raise ValueError('Latitude is out of the valid range for DIGIPIN.')
-    if not (BOUNDS['minLon'] <= lon <= BOUNDS['maxLon']):
-        raise ValueError('Longitude is out of the valid range for DIGIPIN.')
-
-    min_lat, max_lat = BOUNDS['minLat'], BOUNDS['maxLat']
-    min_lon, max_lon = BOUNDS['minLon'], BOUNDS['maxLon']
-
-    digipin_chars = []
-
-    for _ in range(10):
-        lat_div = (max_lat - min_lat) / 4
-        lon_div = (max_lon - min_lon) / 4
-
-        # Calculate column index (standard)
-        col = math.floor((lon - min_lon) / lon_div)
-        # Calculate row index (reversed logic as per original source)
-        row = 3 - math.floor((lat - min_lat) / lat_div)
-
-        # Clamp values to ensure they are within the 0-3 range, handling edge cases
-        row = max(0, min(row, 3))
-        col = max(0, min(col, 3))
-
-        digipin_chars.append(DIGIPIN_GRID[row][col])
-
-        # Update (zoom into) the bounding box for the next iteration
-        # Latitude update uses reversed logic
-        new_max_lat = min_lat + lat_div * (4 - row)
-        new_min_lat = min_lat + lat_div * (3 - row)
-        
-        # Longitude update is standard
-        new_min_lon = min_lon + lon_div * col
-        new_max_lon = new_min_lon + lon_div
-        
-        min_lat, max_lat = new_min_lat, new_max_lat
-        min_lon, max_lon = new_min_lon, new_max_lon
-
-    # Add hyphens for readability, matching the standard format
-    return f"{''.join(digipin_chars[:3])}-{''.join(digipin_chars[3:6])}-{''.join(digipin_chars[6:])}"
-
-
-def get_lat_lng_from_digipin(digipin: str) -> dict:
-    """
-    Decodes a DIGIPIN back into its central latitude and longitude.
-
-    Args:
-        digipin: The 10-character DIGIPIN string (hyphens are optional).
-
-    Returns:
-        A dictionary containing the 'latitude' and 'longitude' as strings
-        formatted to 6 decimal places.
-
-    Raises:
-        ValueError: If the DIGIPIN is invalid (wrong length or characters).
-    """
-    pin = digipin.replace('-', '')
-    if len(pin) != 10:
-        raise ValueError('Invalid DIGIPIN: Must contain 10 alphanumeric characters.')
-
-    min_lat, max_lat = BOUNDS['minLat'], BOUNDS['maxLat']
-    min_lon, max_lon = BOUNDS['minLon'], BOUNDS['maxLon']
-
-    for char in pin:
-        if char not in CHAR_TO_INDEX:
-            raise ValueError(f"Invalid character '{char}' in DIGIPIN.")
-        
-        ri, ci = CHAR_TO_INDEX[char]
-
-        lat_div = (max_lat - min_lat) / 4
-        lon_div = (max_lon - min_lon) / 4
-
-        # Update bounding box based on the character's grid position
-        # Latitude uses reversed logic (subtracting from max_lat)
-        new_min_lat = max_lat - lat_div * (ri + 1)
-        new_max_lat = max_lat - lat_div * ri
-
-        # Longitude is standard
-        new_min_lon = min_lon + lon_div * ci
-        new_max_lon = min_lon + lon_div * (ci + 1)
-        
-        min_lat, max_lat = new_min_lat, new_max_lat
-        min_lon, max_lon = new_min_lon, new_max_lon
-
-    # Calculate the center of the final, small bounding box
-    center_lat = (min_lat + max_lat) / 2
-    center_lon = (min_lon + max_lon) / 2
-
-    return {
-        'latitude': f"{center_lat:.6f}",
-        'longitude': f"{center_lon:.6f}"
+import numpy as np
+from numba import njit, prange
+
+# Constants translated from the JavaScript source
+DIGIPIN_GRID = [
+    ['F', 'C', '9', '8'],
+    ['J', '3', '2', '7'],
+    ['K', '4', '5', '6'],
+    ['L', 'M', 'P', 'T']
+]
+
+
+BOUNDS = {
+    'minLat': 2.5,
+    'maxLat': 38.5,
+    'minLon': 63.5,
+    'maxLon': 99.5
+}
+
+# For faster decoding, create a lookup map from character to its (row, col) index
+# This is more efficient than searching the grid every time.
+CHAR_TO_INDEX = {
+    char: (r, c)
+    for r, row_list in enumerate(DIGIPIN_GRID)
+    for c, char in enumerate(row_list)
+}
+
+# Same flattened grid as ASCII codes, for the compiled kernels below.
+GRID_CODES = np.array([ord(char) for char in 'FC98J327K456LMPT'], dtype=np.uint8)
+
+# Decode lookup table: ASCII code -> (row, col). 255 marks invalid characters.
+CHAR_DECODE = np.full((256, 2), 255, dtype=np.uint8)
+for _char, (_r, _c) in CHAR_TO_INDEX.items():
+    CHAR_DECODE[ord(_char), 0] = _r
+    CHAR_DECODE[ord(_char), 1] = _c
+
+# Scalar bound constants so the compiled kernels don't touch the dict above.
+MIN_LAT, MAX_LAT = BOUNDS['minLat'], BOUNDS['maxLat']
+MIN_LON, MAX_LON = BOUNDS['minLon'], BOUNDS['maxLon']
+
+
+@njit(cache=True)
+def _digipin_core(lat, lon, out):
+    """Compiled 10-level refinement; writes ASCII codes into out[0:10]."""
+    min_lat, max_lat = MIN_LAT, MAX_LAT
+    min_lon, max_lon = MIN_LON, MAX_LON
+
+    for level in range(10):
+        lat_div = (max_lat - min_lat) / 4.0
+        lon_div = (max_lon - min_lon) / 4.0
+
+        # int() truncation is equivalent to floor for these non-negative
+        # ratios and compiles to a single conversion instruction.
+        col = int((lon - min_lon) / lon_div)
+        row = 3 - int((lat - min_lat) / lat_div)
+
+        # Branchless clamp to [0, 3]: the sign mask of x zeroes negatives,
+        # the sign mask of (3 - x) pins anything above 3 to exactly 3.
+        row &= ~(row >> 63)
+        row ^= (row ^ 3) & ((3 - row) >> 63)
+        col &= ~(col >> 63)
+        col ^= (col ^ 3) & ((3 - col) >> 63)
+
+        out[level] = GRID_CODES[row * 4 + col]
+
+        # Zoom into the bounding box, latitude reversed as in get_digipin.
+        max_lat = min_lat + lat_div * (4 - row)
+        min_lat = min_lat + lat_div * (3 - row)
+        min_lon = min_lon + lon_div * col
+        max_lon = min_lon + lon_div
+
+
+@njit(cache=True)
+def _digipin_decode_core(codes):
+    """Compiled decode of 10 validated ASCII codes to the cell center."""
+    min_lat, max_lat = MIN_LAT, MAX_LAT
+    min_lon, max_lon = MIN_LON, MAX_LON
+
+    for i in range(codes.shape[0]):
+        ri = CHAR_DECODE[codes[i], 0]
+        ci = CHAR_DECODE[codes[i], 1]
+
+        lat_div = (max_lat - min_lat) / 4.0
+        lon_div = (max_lon - min_lon) / 4.0
+
+        new_min_lat = max_lat - lat_div * (ri + 1)
+        new_max_lat = max_lat - lat_div * ri
+        new_min_lon = min_lon + lon_div * ci
+        new_max_lon = min_lon + lon_div * (ci + 1)
+
+        min_lat, max_lat = new_min_lat, new_max_lat
+        min_lon, max_lon = new_min_lon, new_max_lon
+
+    return (min_lat + max_lat) / 2.0, (min_lon + max_lon) / 2.0
+
+
+@njit(parallel=True, cache=True)
+def _digipin_batch(lat, lon, out):
+    """Compiled row-parallel batch encode; fills out[i] with 'XXX-XXX-XXXX'."""
+    for i in prange(lat.shape[0]):
+        buf = np.empty(10, dtype=np.uint8)
+        _digipin_core(lat[i], lon[i], buf)
+        out[i, 0:3] = buf[0:3]
+        out[i, 3] = 45  # '-'
+        out[i, 4:7] = buf[3:6]
+        out[i, 7] = 45
+        out[i, 8:12] = buf[6:10]
+
+
+def get_digipin(lat: float, lon: float) -> str:
+    """
+    Encodes a latitude and longitude into a 10-digit alphanumeric DIGIPIN.
+
+    Args:
+        lat: The latitude coordinate.
+        lon: The longitude coordinate.
+
+    Returns:
+        The formatted 10-character DIGIPIN string (e.g., "4P3-JK8-52C9").
+
+    Raises:
+        ValueError: If the latitude or longitude is out of the defined bounds.
+    """
+    if not (BOUNDS['minLat'] <= lat <= BOUNDS['maxLat']):
+        raise ValueError('Latitude is out of the valid range for DIGIPIN.')
+    if not (BOUNDS['minLon'] <= lon <= BOUNDS['maxLon']):
+        raise ValueError('Longitude is out of the valid range for DIGIPIN.')
+
+    codes = np.empty(10, dtype=np.uint8)
+    _digipin_core(lat, lon, codes)
+    pin = codes.tobytes().decode('ascii')
+
+    # Add hyphens for readability, matching the standard format
+    return f"{pin[:3]}-{pin[3:6]}-{pin[6:]}"
+
+
+def get_digipin_batch(lat, lon) -> np.ndarray:
+    """
+    Encodes whole arrays of latitudes and longitudes into DIGIPINs at once.
+
+    This is the vectorized equivalent of calling get_digipin per row: the
+    compiled kernel splits the rows across all CPU cores, so the per-row
+    Python overhead disappears and the encode scales with core count.
+
+    Args:
+        lat: Array-like of latitude coordinates.
+        lon: Array-like of longitude coordinates.
+
+    Returns:
+        An object ndarray of formatted DIGIPIN strings. Entries whose
+        coordinates are NaN or outside the DIGIPIN bounds are None instead
+        of raising, mirroring how the row-wise pipeline treated bad rows.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    valid = (
+        (lat >= BOUNDS['minLat']) & (lat <= BOUNDS['maxLat'])
+        & (lon >= BOUNDS['minLon']) & (lon <= BOUNDS['maxLon'])
+    )
+    # Park invalid rows on the lower bounds so the arithmetic below stays
+    # finite; their results are discarded via the mask at the end.
+    lat = np.where(valid, lat, BOUNDS['minLat'])
+    lon = np.where(valid, lon, BOUNDS['minLon'])
+
+    n = lat.shape[0]
+    out = np.empty((n, 12), dtype=np.uint8)
+    _digipin_batch(lat, lon, out)
+
+    # Reinterpret each 12-byte row as one fixed-width string, no copies.
+    pins = out.view('S12').ravel()
+    result = np.char.decode(pins, 'ascii').astype(object)
+    result[~valid] = None
+    return result
+
+
+def get_lat_lng_from_digipin(digipin: str) -> dict:
+    """
+    Decodes a DIGIPIN back into its central latitude and longitude.
+
+    Args:
+        digipin: The 10-character DIGIPIN string (hyphens are optional).
+
+    Returns:
+        A dictionary containing the 'latitude' and 'longitude' as strings
+        formatted to 6 decimal places.
+
+    Raises:
+        ValueError: If the DIGIPIN is invalid (wrong length or characters).
+    """
+    pin = digipin.replace('-', '')
+    if len(pin) != 10:
+        raise ValueError('Invalid DIGIPIN: Must contain 10 alphanumeric characters.')
+
+    for char in pin:
+        if char not in CHAR_TO_INDEX:
+            raise ValueError(f"Invalid character '{char}' in DIGIPIN.")
+
+    # Characters are validated above, so the compiled core can assume the
+    # lookup table always hits.
+    codes = np.frombuffer(pin.encode('ascii'), dtype=np.uint8)
+    center_lat, center_lon = _digipin_decode_core(codes)
+
+    return {
+        'latitude': f"{center_lat:.6f}",
+        'longitude': f"{center_lon:.6f}"
     }
\ No newline at end of file
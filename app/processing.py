@@ -1,256 +1,633 @@
-# app/processing.py
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from tqdm import tqdm
-from datetime import time, datetime
-import io
-import yaml
-from app.digipin import get_digipin
-
-tqdm.pandas()
-
-# --- Configuration ---
-SHAPEFILE_PATH = "data/India_Districts.shp"
-MAPPING_FILE_PATH = "data/district_mapping.yml"
-SHP_DISTRICT_COL = "Dist_Name"
-SHP_STATE_COL = "State_Name" 
-
-# It will be loaded lazily on the first request.
-shapefile_for_join_cache = None 
-
-def load_and_prepare_shapefile():
-    """
-    Loads the shapefile and applies the custom business name mapping from a YAML file.
-    This is run once on application startup.
-    """
-    print("Loading shapefile...")
-    try:
-        india_gdf = gpd.read_file(SHAPEFILE_PATH)
-        india_gdf = india_gdf.to_crs(epsg=4326)
-    except Exception as e:
-        print(f"CRITICAL ERROR: Could not load shapefile. Error: {e}")
-        return None
-
-    print("Loading and parsing district mapping YAML file...")
-    try:
-        with open(MAPPING_FILE_PATH, 'r') as f:
-            mapping_data = yaml.safe_load(f)
-        if not mapping_data:
-            mapping_data = {}
-    except FileNotFoundError:
-        print(f"WARNING: Mapping file not found at {MAPPING_FILE_PATH}. Using raw shapefile names.")
-        mapping_data = {}
-    except Exception as e:
-        print(f"CRITICAL ERROR: Could not read or parse mapping YAML file. Error: {e}")
-        return None
-
-    def get_mapped_district(row):
-        state_name = row[SHP_STATE_COL]
-        district_name = row[SHP_DISTRICT_COL]
-
-        district_map_for_state = mapping_data.get(state_name)
-
-        if district_map_for_state:
-            return district_map_for_state.get(district_name, district_name)
-        
-        return district_name
-
-    india_gdf['master_district'] = india_gdf.apply(get_mapped_district, axis=1)
-    india_gdf['master_state'] = india_gdf[SHP_STATE_COL].str.title()
-    print("Mapping applied successfully from YAML.")
-
-    shapefile_for_join = india_gdf[['master_state', 'master_district', 'geometry']].copy()
-    shapefile_for_join.rename(columns={
-        'master_district': 'found_district',
-        'master_state': 'found_state'
-    }, inplace=True)
-    
-    return shapefile_for_join
-
-def parse_mixed_formats(series, formats):
-    """
-    Tries to parse a pandas Series with a list of different date formats.
-    """
-    # Start with an empty series to hold the results
-    parsed_series = pd.Series(pd.NaT, index=series.index)
-    to_parse = series.copy()
-
-    for fmt in formats:
-        converted = pd.to_datetime(to_parse, format=fmt, errors='coerce')
-        parsed_series = parsed_series.fillna(converted)    
-        to_parse = to_parse[converted.isna()]
-
-    # If any strings are left over after trying all formats, try one last time automatically
-    if not to_parse.empty:
-        last_try = pd.to_datetime(to_parse, errors='coerce')
-        parsed_series = parsed_series.fillna(last_try)
-
-    return parsed_series
-
-def run_processing_pipeline(planned_visit_file, unplanned_visit_file, counters_file, users_file, start_date_str: str, end_date_str: str):
-    """
-    Main function to execute the entire data processing logic.
-    This version IGNORES operational city/state columns and relies 100% on the shapefile for geocoding.
-    """
-
-    # --- Using global cache for shapefile_for_join ---
-    global shapefile_for_join_cache 
-
-    if shapefile_for_join_cache is None:
-        print("Shapefile data not yet loaded. Loading now...")
-        shapefile_for_join_cache = load_and_prepare_shapefile()
-        if shapefile_for_join_cache is None:
-            raise RuntimeError("Shapefile could not be loaded on demand. Cannot process data.")
-    else:
-        print("Shapefile data already loaded in memory. Reusing cache.")
-
-    # Using cached data for processing
-    shapefile_for_join = shapefile_for_join_cache
-
-    # Step 1: Read all uploaded files into DataFrames
-    counters = pd.read_csv(counters_file)
-    pv = pd.read_csv(planned_visit_file)
-    uv = pd.read_csv(unplanned_visit_file, encoding='cp1252', low_memory=False, dtype={1: str, 6: str})
-    users = pd.read_csv(users_file)
-
-    # Step 2: Pre-processing logic
-    pv = pv[pv['Task Completed'].notna()].copy()
-    counters_unique = counters.drop_duplicates('Counter Code', keep='first').set_index('Counter Code')
-    pv['Latitude']  = pv['Counter Code'].map(counters_unique['Latitude'])
-    pv['Longitude'] = pv['Counter Code'].map(counters_unique['Longitude'])
-    pv.rename(columns={'Task Completed':'CompletedOn'}, inplace=True)
-    pv['visit_type'] = 'Planned'
-    
-    uv.rename(columns={'Activity Date':'CompletedOn', 'Activity Created By':'Task Owner', 'Activity Created By Email':'Task Owner Email'}, inplace=True)
-    uv['visit_type'] = 'Unplanned'
-
-    common_cols = [
-        'Counter Name','Counter Number','Counter Type','Counter Stage',
-        'Counter Code','New or Existing','CompletedOn',
-        'Task Owner','Task Owner Email','Latitude', 'Longitude',
-        'Operational Cities','Operational States','Taluka or District',
-        'visit_type'
-    ]
-    
-    df = pd.concat([pv[common_cols], uv[common_cols]], ignore_index=True)
-    df['Latitude'] = pd.to_numeric(df['Latitude'], errors='coerce')
-    df['Longitude'] = pd.to_numeric(df['Longitude'], errors='coerce')
-
-    # Step 3: Concatenate visit data
-    print(f"Original record count: {len(df)}")
-    known_formats = [
-        '%d-%m-%Y %H:%M',        
-        '%d-%b-%Y %H:%M:%S',
-    ]
-    
-    print(f"Attempting to parse 'CompletedOn' with formats: {known_formats}")
-    df['CompletedOn'] = parse_mixed_formats(df['CompletedOn'], formats=known_formats)
-
-    # Now, check for any rows that *still* failed after trying all formats
-    failed_count = df['CompletedOn'].isna().sum()
-    if failed_count > 0:
-        print(f"WARNING: Dropping {failed_count} rows where 'CompletedOn' could not be parsed with any known format.")
-        df.dropna(subset=['CompletedOn'], inplace=True)
-
-    start_date = pd.to_datetime(start_date_str).date()
-    end_date = pd.to_datetime(end_date_str).date()
-    
-    # Create a boolean mask to filter rows within the date range (inclusive)
-    date_range_mask = (df['CompletedOn'].dt.date >= start_date) & (df['CompletedOn'].dt.date <= end_date)
-    df = df[date_range_mask].copy()
-    
-    print(f"Record count after filtering for date range {start_date} to {end_date}: {len(df)}")
-
-    if df.empty:
-        print("No data found for the selected date. Returning an empty report.")
-        all_cols = list(df.columns) + ['District', 'State', 'digipin', 'Employee Id', 'first_counter_visit_datetime', 'last_counter_visit_datetime', 'late_start', 'worked_late']
-        return pd.DataFrame(columns=all_cols)
-
-    # --- Step 4: NEW TIME-BASED COLUMNS (Corrected Logic) ---
-    print("Calculating daily first/last visit times and flags...")
-
-    # Create a 'date' column to group by user AND day
-    df['visit_date'] = df['CompletedOn'].dt.date
-
-    # a) Group by user AND day to get the first/last visit for each day in the range
-    df['first_counter_visit_datetime'] = df.groupby(['Task Owner Email', 'visit_date'])['CompletedOn'].transform('min')
-    df['last_counter_visit_datetime'] = df.groupby(['Task Owner Email', 'visit_date'])['CompletedOn'].transform('max')
-
-    # b) Identify the unique row index for the first and last visit of each user FOR EACH DAY
-    first_visit_indices = df.loc[df.groupby(['Task Owner Email', 'visit_date'])['CompletedOn'].idxmin()].index
-    last_visit_indices = df.loc[df.groupby(['Task Owner Email', 'visit_date'])['CompletedOn'].idxmax()].index
-    
-    # c) Define thresholds and initialize columns
-    late_start_threshold = time(9, 15)
-    late_finish_threshold = time(16, 0)
-    df['late_start'] = pd.NA
-    df['worked_late'] = pd.NA
-    
-    # d) Calculate flags based on the daily first/last visits
-    df.loc[first_visit_indices, 'late_start'] = (df.loc[first_visit_indices, 'first_counter_visit_datetime'].dt.time > late_start_threshold).astype(int)
-    df.loc[last_visit_indices, 'worked_late'] = (df.loc[last_visit_indices, 'last_counter_visit_datetime'].dt.time > late_finish_threshold).astype(int)
-
-    df.drop(columns=['visit_date'], inplace=True) # dropping the helper 'visit_date' column
-    
-    # --- Step 5: SIMPLIFIED & DIRECT GEOCODING LOGIC ---
-    print("Starting geocoding process with shapefile for all valid lat/long pairs...")
-
-    # Create new columns for our results, initialized as empty
-    df['District'] = pd.NA
-    df['State'] = pd.NA
-
-     # --- Part A: Process rows WITH lat/lon using the shapefile ---
-    has_lat_lon_mask = df['Latitude'].notna() & df['Longitude'].notna()
-    if has_lat_lon_mask.any():
-        print(f"Found {has_lat_lon_mask.sum()} rows with coordinates to geocode.")
-        points_to_process_gdf = gpd.GeoDataFrame(
-            df[has_lat_lon_mask], 
-            geometry=gpd.points_from_xy(df.loc[has_lat_lon_mask, 'Longitude'], df.loc[has_lat_lon_mask, 'Latitude']),
-            crs="EPSG:4326"
-        )
-        merged_gdf = gpd.sjoin(
-            points_to_process_gdf, 
-            shapefile_for_join, 
-            how="left", 
-            predicate="within"
-        )
-        # Assign results back to the main DataFrame
-        df.loc[has_lat_lon_mask, 'District'] = merged_gdf['found_district'].values
-        df.loc[has_lat_lon_mask, 'State'] = merged_gdf['found_state'].values
-
-    # --- Part B: Process rows WITHOUT lat/lon using operational columns ---
-    no_lat_lon_mask = ~has_lat_lon_mask
-    if no_lat_lon_mask.any():
-        print(f"Found {no_lat_lon_mask.sum()} rows without coordinates. Falling back to operational columns.")
-        # Use operational columns as a fallback
-        df.loc[no_lat_lon_mask, 'District'] = df.loc[no_lat_lon_mask, 'Operational Cities'].str.strip().str.title()
-        df.loc[no_lat_lon_mask, 'State'] = df.loc[no_lat_lon_mask, 'Operational States'].str.strip().str.title()
-        
-        # Further fallback: if 'Operational Cities' is also empty, try 'Taluka or District'
-        fallback_mask = no_lat_lon_mask & df['District'].isna()
-        df.loc[fallback_mask, 'District'] = df.loc[fallback_mask, 'Taluka or District'].str.strip().str.title()
-
-    print("Conditional geocoding complete.")
-
-    # Step 6: Process for 'digipin'
-    print("Processing for digipin...")
-    def safe_digipin(row):
-        if pd.isna(row['Latitude']) or pd.isna(row['Longitude']):
-            return None
-        try:
-            return get_digipin(row['Latitude'], row['Longitude'])
-        except Exception:
-            return None
-
-    df['digipin'] = df.progress_apply(safe_digipin, axis=1)
-    
-    user_grouped = users.groupby("Email Address", as_index=False).agg({"Employee Id": "first"})
-    df_final = pd.merge(left=df, right=user_grouped, left_on="Task Owner Email", right_on="Email Address", how="left")
-    
-    df_final['late_start'] = df_final['late_start'].astype('Int64').astype(str).replace('<NA>', '')
-    df_final['worked_late'] = df_final['worked_late'].astype('Int64').astype(str).replace('<NA>', '')
-
-    df_final.drop(columns=['geometry', 'index_right'], errors='ignore', inplace=True)
-    print("Processing finished.")
-    return df_final
\ No newline at end of file
+# app/processing.py
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+from pyarrow import csv as pacsv
+import shapely
+from shapely.geometry import Point
+from datetime import time, datetime
+import io
+import os
+import yaml
+from numba import njit, prange
+from app.digipin import get_digipin_batch
+
+# --- Configuration ---
+SHAPEFILE_PATH = "data/India_Districts.shp"
+SHAPEFILE_PARQUET_PATH = "data/shapefile_for_join.parquet"
+MAPPING_FILE_PATH = "data/district_mapping.yml"
+SHP_DISTRICT_COL = "Dist_Name"
+SHP_STATE_COL = "State_Name"
+
+# Resolution of the flat-grid cell index over the district polygons.
+# 0.1 deg (~11 km) resolves roughly half of India's area without any
+# polygon test and builds in a few seconds, once per process.
+CELL_SIZE_DEG = 0.1
+
+# It will be loaded lazily on the first request.
+shapefile_for_join_cache = None
+district_cell_index_cache = None
+
+def _flatten_district_mapping(mapping_data):
+    """
+    Flattens the nested YAML mapping into one (state, district) -> name
+    dict: a single hash probe per lookup and the shape Series.map needs.
+    """
+    return {
+        (state, old_name): new_name
+        for state, district_map in (mapping_data or {}).items() if district_map
+        for old_name, new_name in district_map.items()
+    }
+
+def load_and_prepare_shapefile():
+    """
+    Loads the shapefile and applies the custom business name mapping from a YAML file.
+    This is run once on application startup.
+
+    The prepared result is cached as GeoParquet: parsing the ESRI shapefile,
+    reprojecting and re-applying the mapping takes seconds on every cold
+    start, while reading the columnar cache takes tens of milliseconds.
+    """
+    if os.path.exists(SHAPEFILE_PARQUET_PATH):
+        print("Loading prepared shapefile from GeoParquet cache...")
+        try:
+            return gpd.read_parquet(SHAPEFILE_PARQUET_PATH)
+        except Exception as e:
+            print(f"WARNING: Could not read GeoParquet cache, rebuilding. Error: {e}")
+
+    print("Loading shapefile...")
+    try:
+        india_gdf = gpd.read_file(SHAPEFILE_PATH)
+        india_gdf = india_gdf.to_crs(epsg=4326)
+    except Exception as e:
+        print(f"CRITICAL ERROR: Could not load shapefile. Error: {e}")
+        return None
+
+    print("Loading and parsing district mapping YAML file...")
+    try:
+        with open(MAPPING_FILE_PATH, 'r') as f:
+            mapping_data = yaml.safe_load(f)
+        if not mapping_data:
+            mapping_data = {}
+    except FileNotFoundError:
+        print(f"WARNING: Mapping file not found at {MAPPING_FILE_PATH}. Using raw shapefile names.")
+        mapping_data = {}
+    except Exception as e:
+        print(f"CRITICAL ERROR: Could not read or parse mapping YAML file. Error: {e}")
+        return None
+
+    # Resolve the flattened mapping with a single vectorized map instead
+    # of a per-row apply.
+    flat_mapping = _flatten_district_mapping(mapping_data)
+    keys = pd.MultiIndex.from_arrays(
+        [india_gdf[SHP_STATE_COL], india_gdf[SHP_DISTRICT_COL]]
+    )
+    india_gdf['master_district'] = pd.Series(
+        keys.map(flat_mapping.get), index=india_gdf.index
+    ).fillna(india_gdf[SHP_DISTRICT_COL])
+    india_gdf['master_state'] = india_gdf[SHP_STATE_COL].str.title()
+    print("Mapping applied successfully from YAML.")
+
+    # Copy-on-write (always on since pandas 3) makes a defensive copy of
+    # this column selection unnecessary.
+    shapefile_for_join = india_gdf[['master_state', 'master_district', 'geometry']]
+    shapefile_for_join.rename(columns={
+        'master_district': 'found_district',
+        'master_state': 'found_state'
+    }, inplace=True)
+
+    try:
+        shapefile_for_join.to_parquet(SHAPEFILE_PARQUET_PATH)
+        print(f"Saved prepared shapefile to {SHAPEFILE_PARQUET_PATH} for faster startups.")
+    except Exception as e:
+        print(f"WARNING: Could not write GeoParquet cache. Error: {e}")
+
+    return shapefile_for_join
+
+def _cell_ids(lon, lat, cell_size=CELL_SIZE_DEG):
+    """
+    Maps longitudes/latitudes to the integer ids of their grid cells.
+    """
+    ii = np.floor(np.asarray(lon) / cell_size).astype(np.int64)
+    jj = np.floor(np.asarray(lat) / cell_size).astype(np.int64)
+    # jj stays well below 100000, so this pairing is collision-free.
+    return ii * 100000 + jj
+
+def _flatten_polygon_rings(geoms):
+    """
+    Flattens polygon/multipolygon rings into SoA arrays for the compiled
+    point-in-polygon kernel: vertex arrays, per-ring offsets into them,
+    and each polygon's span of rings.
+    """
+    xs_parts, ys_parts = [], []
+    ring_offsets = [0]
+    ring_lo = np.empty(len(geoms), dtype=np.int64)
+    ring_hi = np.empty(len(geoms), dtype=np.int64)
+    for poly_idx, geom in enumerate(geoms):
+        ring_lo[poly_idx] = len(ring_offsets) - 1
+        for part in shapely.get_parts(geom):
+            for ring in (part.exterior, *part.interiors):
+                coords = np.asarray(ring.coords)
+                xs_parts.append(coords[:, 0])
+                ys_parts.append(coords[:, 1])
+                ring_offsets.append(ring_offsets[-1] + len(coords))
+        ring_hi[poly_idx] = len(ring_offsets) - 1
+    return {
+        'xs': np.concatenate(xs_parts),
+        'ys': np.concatenate(ys_parts),
+        'ring_offsets': np.asarray(ring_offsets, dtype=np.int64),
+        'ring_lo': ring_lo,
+        'ring_hi': ring_hi,
+    }
+
+@njit(parallel=True, cache=True)
+def _pip_pairs(px, py, poly_ids, xs, ys, ring_offsets, ring_lo, ring_hi, out):
+    """
+    Even-odd ray-casting test for (point, polygon) candidate pairs over the
+    flattened ring arrays; crossing all of a polygon's rings at once makes
+    holes and multipolygon parts fall out of the parity count naturally.
+    """
+    for k in prange(px.shape[0]):
+        x, y = px[k], py[k]
+        pid = poly_ids[k]
+        inside = False
+        for r in range(ring_lo[pid], ring_hi[pid]):
+            start, stop = ring_offsets[r], ring_offsets[r + 1]
+            # Rings are closed (first vertex == last), so consecutive
+            # vertices alone enumerate every segment.
+            for i in range(start, stop - 1):
+                y1, y2 = ys[i], ys[i + 1]
+                if (y1 > y) != (y2 > y):
+                    x_cross = (xs[i + 1] - xs[i]) * (y - y1) / (y2 - y1) + xs[i]
+                    if x < x_cross:
+                        inside = not inside
+        out[k] = inside
+
+def build_cell_index(shapefile_for_join, cell_size=CELL_SIZE_DEG):
+    """
+    Precomputes a flat-grid cell index over the district polygons.
+
+    Each district is covered with fixed-size lat/lon cells. A cell that lies
+    fully inside exactly one district resolves a point with a single hashed
+    lookup — no polygon math at all. Cells crossed by a district edge are
+    kept in a separate 'boundary' table; only points landing in those need
+    an exact point-in-polygon test. Points in cells touching no district
+    can be rejected immediately.
+    """
+    print("Building district cell index...")
+    interior = {}
+    boundary = {}
+
+    geoms = shapefile_for_join.geometry.values
+    # Prepared polygons carry a segment index, so the intersects/within
+    # tests in the loop below skip the full ray-casting scan.
+    shapely.prepare(geoms)
+    for poly_idx, geom in enumerate(geoms):
+        minx, miny, maxx, maxy = geom.bounds
+        i_range = np.arange(int(np.floor(minx / cell_size)), int(np.floor(maxx / cell_size)) + 1)
+        j_range = np.arange(int(np.floor(miny / cell_size)), int(np.floor(maxy / cell_size)) + 1)
+        ii, jj = np.meshgrid(i_range, j_range, indexing='ij')
+        ii, jj = ii.ravel(), jj.ravel()
+
+        cells = shapely.box(ii * cell_size, jj * cell_size,
+                            (ii + 1) * cell_size, (jj + 1) * cell_size)
+        touches = shapely.intersects(cells, geom)
+        inside = shapely.within(cells, geom)
+        cids = ii * 100000 + jj
+
+        for cid in cids[inside]:
+            if cid in boundary:
+                boundary[cid].append(poly_idx)
+            elif cid in interior:
+                # Two districts claim this cell fully (overlapping slivers);
+                # demote it to a boundary cell with both as candidates.
+                boundary[cid] = [interior.pop(cid), poly_idx]
+            else:
+                interior[cid] = poly_idx
+
+        for cid in cids[touches & ~inside]:
+            if cid in interior:
+                boundary[cid] = [interior.pop(cid), poly_idx]
+            else:
+                boundary.setdefault(cid, []).append(poly_idx)
+
+    print(f"Cell index ready: {len(interior)} interior cells, {len(boundary)} boundary cells.")
+    return {
+        # Series so point lookups can go through a single vectorized .map
+        'interior': pd.Series(interior, dtype=np.int64),
+        'boundary': boundary,
+        'boundary_ids': np.fromiter(boundary.keys(), dtype=np.int64, count=len(boundary)),
+        # Per-polygon AABBs (minx, miny, maxx, maxy) for cheap numpy-level
+        # rejection of candidates before any real point-in-polygon test.
+        'bounds': shapely.bounds(geoms),
+        # Flattened ring arrays for the compiled ray-casting kernel.
+        'rings': _flatten_polygon_rings(geoms),
+    }
+
+def get_district_cell_index(shapefile_for_join):
+    """
+    Returns the cached cell index, building it on the first call.
+    """
+    global district_cell_index_cache
+    if district_cell_index_cache is None:
+        district_cell_index_cache = build_cell_index(shapefile_for_join)
+    return district_cell_index_cache
+
+def read_csv_header(file_obj, encoding='utf-8'):
+    """
+    Reads just the header row of an uploaded CSV and rewinds the file.
+    """
+    header_line = file_obj.readline()
+    file_obj.seek(0)
+    if isinstance(header_line, bytes):
+        header_line = header_line.decode(encoding)
+    return [name.strip().strip('"') for name in header_line.rstrip('\r\n').split(',')]
+
+def read_csv_arrow(file_obj, encoding='utf-8', string_cols=()):
+    """
+    Reads an uploaded CSV with PyArrow's multithreaded parser.
+
+    Much faster than pd.read_csv for the large visit exports; string_cols
+    forces columns that must stay text (mixed-type codes) to string instead
+    of letting type inference pick a numeric dtype.
+    """
+    read_options = pacsv.ReadOptions(use_threads=True, encoding=encoding)
+    # strings_can_be_null makes empty cells null in text columns, matching
+    # how pd.read_csv turned them into NaN.
+    convert_options = pacsv.ConvertOptions(
+        strings_can_be_null=True,
+        column_types={col: pa.string() for col in string_cols}
+    )
+    table = pacsv.read_csv(
+        file_obj, read_options=read_options, convert_options=convert_options
+    )
+    # Plain to_pandas keeps the NumPy-backed dtypes the rest of the
+    # pipeline (groupby, sjoin, digipin) already expects.
+    return table.to_pandas()
+
+# Datetime formats the CRM exports are known to use, tried in order.
+KNOWN_DATETIME_FORMATS = (
+    '%d-%m-%Y %H:%M',
+    '%d-%b-%Y %H:%M:%S',
+)
+
+def parse_mixed_formats(series, formats=KNOWN_DATETIME_FORMATS):
+    """
+    Parses a pandas Series mixing the two known date formats.
+
+    One vectorized regex splits the rows by layout — an abbreviated month
+    ('15-Aug-2025 ...') only occurs in the second known format — so each
+    group is parsed exactly once with a fixed format instead of every
+    format re-scanning all previously failed values. Rows that still fail
+    hit a format='mixed' fallback, but only when few remain: that pass
+    guesses the format per value, so a large leftover means genuinely bad
+    data that the caller drops anyway.
+    """
+    notna = series.notna()
+    is_month_abbr = series.str.contains(r'-[A-Za-z]{3}-', regex=True, na=False)
+
+    parsed_series = pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+    for mask, fmt in ((notna & ~is_month_abbr, formats[0]), (is_month_abbr, formats[1])):
+        if mask.any():
+            parsed_series[mask] = pd.to_datetime(series[mask], format=fmt, errors='coerce')
+
+    to_parse = series[parsed_series.isna() & notna]
+    if not to_parse.empty:
+        threshold = max(100, int(0.001 * len(series)))
+        if len(to_parse) > threshold:
+            print(f"Skipping auto-parse fallback for {len(to_parse)} rows (> {threshold}); leaving them unparsed.")
+        else:
+            converted = pd.to_datetime(to_parse, format='mixed', dayfirst=True, errors='coerce')
+            parsed_series = parsed_series.fillna(converted)
+
+    return parsed_series
+
+def read_visits_streaming(file_obj, start_ts, end_ts, encoding='utf-8',
+                          string_cols=(), rename_map=None):
+    """
+    Streams a visit CSV in arrow record batches, renaming, date-parsing and
+    window-filtering each batch as it is decoded.
+
+    Peak memory stays at one batch plus the surviving rows, and visits
+    outside the requested window are culled before any downstream step
+    sees them, instead of the whole export being materialized first.
+
+    Returns (frame, total_rows, unparseable_rows).
+    """
+    read_options = pacsv.ReadOptions(use_threads=True, encoding=encoding)
+    # The streaming reader locks every column's type from the first block,
+    # so the date column must be declared, not inferred: a first block of
+    # all-blank completions would lock it to null and the first real date
+    # in a later block would abort the read.
+    date_col = 'CompletedOn'
+    if rename_map:
+        for raw_name, new_name in rename_map.items():
+            if new_name == 'CompletedOn':
+                date_col = raw_name
+                break
+    column_types = {col: pa.string() for col in string_cols}
+    column_types[date_col] = pa.string()
+    convert_options = pacsv.ConvertOptions(
+        strings_can_be_null=True,
+        column_types=column_types,
+    )
+    chunks = []
+    total_rows = 0
+    unparseable_rows = 0
+    with pacsv.open_csv(file_obj, read_options=read_options,
+                        convert_options=convert_options) as reader:
+        for batch in reader:
+            chunk = batch.to_pandas()
+            if rename_map:
+                chunk.rename(columns=rename_map, inplace=True)
+            total_rows += len(chunk)
+            parsed = parse_mixed_formats(chunk['CompletedOn'])
+            unparseable_rows += int((parsed.isna() & chunk['CompletedOn'].notna()).sum())
+            chunk['CompletedOn'] = parsed
+            keep = ((parsed >= start_ts) & (parsed < end_ts)).to_numpy()
+            chunks.append(chunk[keep])
+        if not chunks:
+            # Header-only export (no data rows): hand back an empty frame
+            # with the declared columns so the pipeline can still build a
+            # report from the other file.
+            empty = reader.schema.empty_table().to_pandas()
+            if rename_map:
+                empty.rename(columns=rename_map, inplace=True)
+            # Arrow infers no type from zero rows; pin the datetime dtype
+            # so the later concat with the other file stays datetime64.
+            empty['CompletedOn'] = empty['CompletedOn'].astype('datetime64[ns]')
+            chunks.append(empty)
+    return pd.concat(chunks, ignore_index=True), total_rows, unparseable_rows
+
+def run_processing_pipeline(planned_visit_file, unplanned_visit_file, counters_file, users_file, start_date_str: str, end_date_str: str):
+    """
+    Main function to execute the entire data processing logic.
+    This version IGNORES operational city/state columns and relies 100% on the shapefile for geocoding.
+    """
+
+    # --- Using global cache for shapefile_for_join ---
+    global shapefile_for_join_cache 
+
+    if shapefile_for_join_cache is None:
+        print("Shapefile data not yet loaded. Loading now...")
+        shapefile_for_join_cache = load_and_prepare_shapefile()
+        if shapefile_for_join_cache is None:
+            raise RuntimeError("Shapefile could not be loaded on demand. Cannot process data.")
+        # Build the cell index together with the shapefile so the geocoding
+        # step never pays index construction mid-request.
+        get_district_cell_index(shapefile_for_join_cache)
+    else:
+        print("Shapefile data already loaded in memory. Reusing cache.")
+
+    # Using cached data for processing
+    shapefile_for_join = shapefile_for_join_cache
+
+    start_ts = pd.Timestamp(start_date_str)
+    end_ts = pd.Timestamp(end_date_str) + pd.Timedelta(days=1)
+
+    # Step 1: Read the uploads. The two visit exports stream batch by batch
+    # with the date window (half-open, so plain int64 datetime compares)
+    # applied as the batches decode — rows outside the window never reach
+    # the rest of the pipeline.
+    counters = read_csv_arrow(counters_file)
+    users = read_csv_arrow(users_file)
+
+    print(f"Attempting to parse 'CompletedOn' with formats: {list(KNOWN_DATETIME_FORMATS)}")
+    pv, pv_total, pv_failed = read_visits_streaming(
+        planned_visit_file, start_ts, end_ts,
+        rename_map={'Task Completed': 'CompletedOn'}
+    )
+    # The unplanned export needs columns 1 and 6 kept as text (the old
+    # dtype={1: str, 6: str}); resolve their names from the header first.
+    uv_header = read_csv_header(unplanned_visit_file, encoding='cp1252')
+    uv, uv_total, uv_failed = read_visits_streaming(
+        unplanned_visit_file, start_ts, end_ts,
+        encoding='cp1252',
+        string_cols=(uv_header[1], uv_header[6]),
+        rename_map={'Activity Date': 'CompletedOn',
+                    'Activity Created By': 'Task Owner',
+                    'Activity Created By Email': 'Task Owner Email'}
+    )
+
+    print(f"Original record count: {pv_total + uv_total}")
+    failed_count = pv_failed + uv_failed
+    if failed_count > 0:
+        print(f"WARNING: Dropping {failed_count} rows where 'CompletedOn' could not be parsed with any known format.")
+
+    # Step 2: Pre-processing logic, now only over rows inside the window
+    # Plain-dict lookups skip the Series indexer machinery in .map
+    counters_unique = counters.drop_duplicates('Counter Code', keep='first')
+    counter_codes = counters_unique['Counter Code'].to_numpy()
+    lat_map = dict(zip(counter_codes, counters_unique['Latitude'].to_numpy()))
+    lon_map = dict(zip(counter_codes, counters_unique['Longitude'].to_numpy()))
+    pv['Latitude']  = pv['Counter Code'].map(lat_map)
+    pv['Longitude'] = pv['Counter Code'].map(lon_map)
+    pv['visit_type'] = 'Planned'
+    uv['visit_type'] = 'Unplanned'
+
+    common_cols = [
+        'Counter Name','Counter Number','Counter Type','Counter Stage',
+        'Counter Code','New or Existing','CompletedOn',
+        'Task Owner','Task Owner Email','Latitude', 'Longitude',
+        'Operational Cities','Operational States','Taluka or District',
+        'visit_type'
+    ]
+
+    # Step 3: Concatenate visit data
+    df = pd.concat([pv[common_cols], uv[common_cols]], ignore_index=True)
+    df['Latitude'] = pd.to_numeric(df['Latitude'], errors='coerce')
+    df['Longitude'] = pd.to_numeric(df['Longitude'], errors='coerce')
+
+    print(f"Record count after filtering for date range {start_ts.date()} to {(end_ts - pd.Timedelta(days=1)).date()}: {len(df)}")
+
+    if df.empty:
+        print("No data found for the selected date. Returning an empty report.")
+        all_cols = list(df.columns) + ['District', 'State', 'digipin', 'Employee Id', 'first_counter_visit_datetime', 'last_counter_visit_datetime', 'late_start', 'worked_late']
+        return pd.DataFrame(columns=all_cols)
+
+    # --- Step 4: NEW TIME-BASED COLUMNS (Corrected Logic) ---
+    print("Calculating daily first/last visit times and flags...")
+
+    # Categorical owner emails turn the string group key into small int
+    # codes, so the groupby and merge below hash integers, not strings.
+    df['Task Owner Email'] = df['Task Owner Email'].astype('category')
+
+    # Create a 'date' column to group by user AND day. Normalizing keeps the
+    # column as datetime64 (fast int64 group keys) rather than object dates.
+    df['visit_date'] = df['CompletedOn'].dt.normalize()
+
+    # a) One grouped pass gets first/last visit times AND their row labels,
+    # instead of four separate hash+scan passes over the frame.
+    visit_agg = (
+        df.groupby(['Task Owner Email', 'visit_date'], sort=False)['CompletedOn']
+        .agg(['min', 'max', 'idxmin', 'idxmax'])
+        .reset_index()
+    )
+
+    # b) Broadcast the per-day min/max back onto the rows with a single merge,
+    # keeping the original row labels so the flag assignments below still work.
+    original_index = df.index
+    df = df.merge(
+        visit_agg[['Task Owner Email', 'visit_date', 'min', 'max']].rename(
+            columns={'min': 'first_counter_visit_datetime',
+                     'max': 'last_counter_visit_datetime'}),
+        on=['Task Owner Email', 'visit_date'],
+        how='left'
+    )
+    df.index = original_index
+
+    first_visit_indices = visit_agg['idxmin']
+    last_visit_indices = visit_agg['idxmax']
+
+    # c) Define thresholds and initialize columns
+    late_start_threshold = time(9, 15)
+    late_finish_threshold = time(16, 0)
+    df['late_start'] = pd.NA
+    df['worked_late'] = pd.NA
+    
+    # d) Calculate flags based on the daily first/last visits
+    df.loc[first_visit_indices, 'late_start'] = (df.loc[first_visit_indices, 'first_counter_visit_datetime'].dt.time > late_start_threshold).astype(int)
+    df.loc[last_visit_indices, 'worked_late'] = (df.loc[last_visit_indices, 'last_counter_visit_datetime'].dt.time > late_finish_threshold).astype(int)
+
+    df.drop(columns=['visit_date'], inplace=True) # dropping the helper 'visit_date' column
+    
+    # --- Step 5: SIMPLIFIED & DIRECT GEOCODING LOGIC ---
+    print("Starting geocoding process with shapefile for all valid lat/long pairs...")
+
+    # Both the shapefile path and the operational-column fallback write into
+    # these arrays; the District/State columns are assigned exactly once at
+    # the end instead of via repeated masked column writes.
+    district_out = np.full(len(df), None, dtype=object)
+    state_out = np.full(len(df), None, dtype=object)
+
+     # --- Part A: Process rows WITH lat/lon using the shapefile ---
+    has_lat_lon_mask = df['Latitude'].notna() & df['Longitude'].notna()
+    has_pos = np.flatnonzero(has_lat_lon_mask.to_numpy())
+    if has_pos.size:
+        print(f"Found {has_pos.size} rows with coordinates to geocode.")
+        cell_index = get_district_cell_index(shapefile_for_join)
+
+        lon = df['Longitude'].to_numpy()[has_pos]
+        lat = df['Latitude'].to_numpy()[has_pos]
+        cids = _cell_ids(lon, lat)
+
+        district_names = shapefile_for_join['found_district'].to_numpy()
+        state_names = shapefile_for_join['found_state'].to_numpy()
+
+        # Interior-cell points resolve with one vectorized hashed lookup.
+        hit = pd.Series(cids).map(cell_index['interior'])
+        resolved = hit.notna().to_numpy()
+        poly_pos = hit.to_numpy()[resolved].astype(np.int64)
+
+        district_out[has_pos[resolved]] = district_names[poly_pos]
+        state_out[has_pos[resolved]] = state_names[poly_pos]
+
+        # Only points in boundary cells need an exact polygon test; points
+        # in cells touching no district stay unmatched with no work at all.
+        needs_exact = ~resolved & np.isin(cids, cell_index['boundary_ids'])
+        print(f"Cell index resolved {int(resolved.sum())} points directly; "
+              f"{int(needs_exact.sum())} need exact polygon tests.")
+        if needs_exact.any():
+            # The boundary cell already names the few candidate districts
+            # per point; expand to (point, polygon) pairs, reject pairs
+            # whose AABB doesn't even contain the point, and run the real
+            # point-in-polygon test only on the survivors.
+            exact_pos = np.flatnonzero(needs_exact)
+            cand_lists = [cell_index['boundary'][cid] for cid in cids[exact_pos]]
+            counts = np.fromiter((len(c) for c in cand_lists), dtype=np.int64, count=len(cand_lists))
+            pt_rep = np.repeat(np.arange(len(cand_lists)), counts)
+            poly_rep = np.fromiter(
+                (p for cands in cand_lists for p in cands), dtype=np.int64
+            )
+
+            px, py = lon[exact_pos][pt_rep], lat[exact_pos][pt_rep]
+            bounds = cell_index['bounds'][poly_rep]
+            in_bbox = (
+                (px >= bounds[:, 0]) & (px <= bounds[:, 2])
+                & (py >= bounds[:, 1]) & (py <= bounds[:, 3])
+            )
+            pt_rep, poly_rep = pt_rep[in_bbox], poly_rep[in_bbox]
+
+            rings = cell_index['rings']
+            inside = np.empty(len(pt_rep), dtype=np.bool_)
+            _pip_pairs(px[in_bbox], py[in_bbox], poly_rep,
+                       rings['xs'], rings['ys'], rings['ring_offsets'],
+                       rings['ring_lo'], rings['ring_hi'], inside)
+            pt_idx, poly_idx = pt_rep[inside], poly_rep[inside]
+
+            # First match wins (districts only overlap in boundary slivers).
+            unique_pts, first_match = np.unique(pt_idx, return_index=True)
+            target = has_pos[exact_pos[unique_pts]]
+            district_out[target] = district_names[poly_idx[first_match]]
+            state_out[target] = state_names[poly_idx[first_match]]
+
+    # --- Part B: Process rows WITHOUT lat/lon using operational columns ---
+    no_pos = np.flatnonzero(~has_lat_lon_mask.to_numpy())
+    if no_pos.size:
+        print(f"Found {no_pos.size} rows without coordinates. Falling back to operational columns.")
+        # Normalize each fallback column once over just the rows that need
+        # it. City/state strings repeat heavily, so strip/title runs once
+        # per distinct value and a map fans the results back out; the
+        # Taluka-or-District fallback folds in via fillna rather than a
+        # second masked pass over the frame.
+        def normalize_names(series):
+            norm = {v: v.strip().title() for v in series.dropna().unique()}
+            return series.map(norm)
+
+        fallback = df.iloc[no_pos]
+        district_fb = normalize_names(fallback['Operational Cities'])
+        district_fb = district_fb.fillna(normalize_names(fallback['Taluka or District']))
+        state_fb = normalize_names(fallback['Operational States'])
+
+        district_out[no_pos] = district_fb.to_numpy()
+        state_out[no_pos] = state_fb.to_numpy()
+
+    df['District'] = district_out
+    df['State'] = state_out
+
+    print("Conditional geocoding complete.")
+
+    # Step 6: Process for 'digipin'
+    print("Processing for digipin...")
+    # Precompute the validity mask and only run the compiled encoder over
+    # rows that actually have coordinates; the rest stay None, just like
+    # the old row-wise version. The batch kernel still bounds-checks, so
+    # out-of-range coordinates also come back as None.
+    lat_vals = df['Latitude'].to_numpy()
+    lon_vals = df['Longitude'].to_numpy()
+    has_coords = ~(np.isnan(lat_vals) | np.isnan(lon_vals))
+    digipin_out = np.full(len(df), None, dtype=object)
+    if has_coords.any():
+        digipin_out[has_coords] = get_digipin_batch(
+            lat_vals[has_coords], lon_vals[has_coords]
+        )
+    df['digipin'] = digipin_out
+    
+    # Only Employee Id is needed from users; a dict map replaces the hash
+    # join. Email Address is kept in the report for parity with the old
+    # merge output: the owner email where a user row matched, blank otherwise.
+    users_unique = users.drop_duplicates('Email Address', keep='first')
+    emp_map = dict(zip(users_unique['Email Address'], users_unique['Employee Id']))
+    df_final = df
+    matched = df_final['Task Owner Email'].isin(emp_map.keys())
+    df_final['Email Address'] = df_final['Task Owner Email'].where(matched)
+    df_final['Employee Id'] = df_final['Task Owner Email'].map(emp_map)
+    
+    # Int8 is plenty for 0/1 flags and an eighth of the Int64 footprint.
+    df_final['late_start'] = df_final['late_start'].astype('Int8').astype(str).replace('<NA>', '')
+    df_final['worked_late'] = df_final['worked_late'].astype('Int8').astype(str).replace('<NA>', '')
+
+    df_final.drop(columns=['geometry', 'index_right'], errors='ignore', inplace=True)
+    print("Processing finished.")
+    return df_final
+
+
+if __name__ == '__main__':
+    # One-time warm-up for deployments: parse the shapefile, apply the YAML
+    # mapping and write the GeoParquet cache so worker processes boot from
+    # the columnar file instead of re-parsing the .shp.
+    #   python -m app.processing
+    if load_and_prepare_shapefile() is None:
+        raise SystemExit(1)
+    print("GeoParquet cache is ready.")
\ No newline at end of file